@@ -4,6 +4,7 @@ import sys
 
 from tortoise import run_async
 
+from kzkitty.api import close_session
 from kzkitty.api.kz import refresh_db_maps
 from kzkitty.bot import bot
 from kzkitty.models import init_db
@@ -12,14 +13,14 @@ logger = logging.getLogger('kzkitty')
 
 async def _refresh() -> None:
     await init_db()
-    await refresh_db_maps()
+    try:
+        await refresh_db_maps()
+    finally:
+        await close_session()
 
 def main(args: list[str]) -> None:
-    try:
+    if sys.platform != 'win32':
         import uvloop
-    except ImportError:
-        pass
-    else:
         loop = uvloop.new_event_loop()
         asyncio.set_event_loop(loop)
         logger.info('Installed uvloop event loop')
@@ -0,0 +1,73 @@
+import asyncio
+import socket
+import time
+from collections.abc import Awaitable, Callable
+from functools import wraps
+from typing import Any, Generic, ParamSpec, TypeVar
+
+from aiohttp import (AsyncResolver, ClientResponse, ClientSession,
+                     DummyCookieJar, TCPConnector)
+
+K = TypeVar('K')
+V = TypeVar('V')
+P = ParamSpec('P')
+R = TypeVar('R')
+
+_session: ClientSession | None = None
+
+class TTLCache(Generic[K, V]):
+    def __init__(self, ttl: float, maxsize: int) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._items: dict[K, tuple[float, V]] = {}
+
+    def get(self, key: K) -> V | None:
+        item = self._items.pop(key, None)
+        if item is None or item[0] < time.monotonic():
+            return None
+        self._items[key] = item
+        return item[1]
+
+    def put(self, key: K, value: V) -> None:
+        self._items.pop(key, None)
+        if len(self._items) >= self.maxsize:
+            del self._items[next(iter(self._items))]
+        self._items[key] = (time.monotonic() + self.ttl, value)
+
+def check_status(r: ClientResponse, exc_type: type[Exception],
+                 message: str) -> None:
+    if r.status != 200:
+        raise exc_type('%s (HTTP %d)' % (message, r.status))
+
+def singleflight(func: Callable[P, Awaitable[R]]
+                 ) -> Callable[P, Awaitable[R]]:
+    inflight: dict[Any, asyncio.Future[R]] = {}
+
+    @wraps(func)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        key = (args, tuple(sorted(kwargs.items())))
+        future = inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            inflight[key] = future
+            future.add_done_callback(lambda _: inflight.pop(key, None))
+        # Shield so one caller being cancelled doesn't cancel the others
+        return await asyncio.shield(future)
+    return wrapper
+
+async def get_session() -> ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = TCPConnector(limit=100, limit_per_host=20,
+                                 resolver=AsyncResolver(),
+                                 family=socket.AF_INET, ttl_dns_cache=600,
+                                 keepalive_timeout=75)
+        _session = ClientSession(connector=connector,
+                                 cookie_jar=DummyCookieJar())
+    return _session
+
+async def close_session() -> None:
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
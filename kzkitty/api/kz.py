@@ -1,17 +1,33 @@
+import asyncio
 import logging
 import re
 from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
 from enum import StrEnum
+from typing import TypeVar
 
-from aiohttp import ClientError, ClientSession
+import msgspec
+import orjson
+from aiohttp import ClientError
 from tortoise.exceptions import DoesNotExist
 
+from kzkitty.api import TTLCache, check_status, get_session, singleflight
 from kzkitty.api.steam import SteamError, name_for_steamid64
 from kzkitty.models import Map, Mode, Type
 
 logger = logging.getLogger('kzkitty.api.kz')
 
+T = TypeVar('T')
+
+MAX_AMBIGUOUS_MAPS = 10
+
+_MAP_NAME_RE = re.compile(r'[A-Za-z0-9_]+')
+
+_MODES_BY_API_NAME = {mode.api_name: mode for mode in Mode}
+
+_thumbnail_cache: TTLCache[str, bytes] = TTLCache(ttl=7 * 86400, maxsize=64)
+_thumbnail_misses: TTLCache[str, bool] = TTLCache(ttl=86400, maxsize=1024)
+
 class APIError(Exception):
     pass
 
@@ -47,7 +63,7 @@ class Rank(StrEnum):
     MASTER = 'Master'
     LEGEND = 'Legend'
 
-@dataclass
+@dataclass(frozen=True)
 class APIMap:
     name: str
     tier: int
@@ -55,7 +71,7 @@ class APIMap:
     vnl_pro_tier: int | None
     thumbnail: bytes | None
 
-@dataclass
+@dataclass(slots=True)
 class PersonalBest:
     id: int
     steamid64: int
@@ -69,6 +85,20 @@ class PersonalBest:
     place: int | None
     date: datetime
 
+class _Record(msgspec.Struct):
+    id: int
+    steamid64: str
+    map_name: str
+    mode: str
+    stage: int
+    time: float
+    teleports: int
+    points: int
+    created_on: str
+    player_name: str | None = None
+
+_records_decoder = msgspec.json.Decoder(list[_Record])
+
 @dataclass
 class Profile:
     player_name: str | None
@@ -80,14 +110,14 @@ class Profile:
 async def _vnl_tiers() -> dict[int, tuple[int, int]]:
     url = 'https://vnl.kz/api/maps'
     try:
-        async with ClientSession() as session:
-            async with session.get(url) as r:
-                if r.status != 200:
-                    logger.error("Couldn't get vnl.kz API maps (HTTP %d)",
-                                 r.status)
-                    return {}
-                json = await r.json()
-    except ClientError:
+        session = await get_session()
+        async with session.get(url) as r:
+            if r.status != 200:
+                logger.error("Couldn't get vnl.kz API maps (HTTP %d)",
+                             r.status)
+                return {}
+            json = orjson.loads(await r.read())
+    except (ClientError, orjson.JSONDecodeError):
         logger.exception("Couldn't get vnl.kz API maps")
         return {}
 
@@ -113,15 +143,13 @@ async def _vnl_tiers() -> dict[int, tuple[int, int]]:
 async def _vnl_tiers_for_map(name: str) -> tuple[int | None, int | None]:
     url = f'https://vnl.kz/api/maps/{name}'
     try:
-        async with ClientSession() as session:
-            async with session.get(url) as r:
-                if r.status == 404:
-                    return 10, 10
-                elif r.status != 200:
-                    raise APIError("Couldn't get vnl.kz map tiers (HTTP %d)" %
-                                   r.status)
-                json = await r.json()
-    except ClientError as e:
+        session = await get_session()
+        async with session.get(url) as r:
+            if r.status == 404:
+                return 10, 10
+            check_status(r, APIError, "Couldn't get vnl.kz map tiers")
+            json = orjson.loads(await r.read())
+    except (ClientError, orjson.JSONDecodeError) as e:
         raise APIError("Couldn't get vnl.kz map tiers") from e
 
     if not isinstance(json, dict):
@@ -133,34 +161,52 @@ async def _vnl_tiers_for_map(name: str) -> tuple[int | None, int | None]:
         raise APIError("Malformed vnl.kz JSON (tpTier/proTier not an int)")
     return tp_tier, pro_tier
 
+async def _vnl_tiers_or_none(name: str) -> tuple[int | None, int | None]:
+    try:
+        return await _vnl_tiers_for_map(name)
+    except APIError:
+        logger.exception("Couldn't get vnl.kz map tiers")
+        return None, None
+
+async def _value(value: T) -> T:
+    return value
+
 async def _thumbnail_for_map(name: str) -> bytes | None:
     thumbnail_url = ('https://raw.githubusercontent.com/KZGlobalTeam/'
                      f'map-images/public/webp/medium/{name}.webp')
-    thumbnail = None
+    thumbnail = _thumbnail_cache.get(name)
+    if thumbnail is not None or _thumbnail_misses.get(name):
+        return thumbnail
+
     try:
-        async with ClientSession() as session:
-            async with session.get(thumbnail_url) as r:
-                if r.status == 200:
-                    thumbnail = await r.content.read()
-                else:
-                    logger.error("Couldn't get map thumbnail (HTTP %d)",
-                                 r.status)
+        session = await get_session()
+        async with session.get(thumbnail_url) as r:
+            if r.status == 200:
+                thumbnail = await r.content.read()
+            elif r.status == 404:
+                # Not every map has an image; don't ask again for a while
+                _thumbnail_misses.put(name, True)
+            else:
+                logger.error("Couldn't get map thumbnail (HTTP %d)",
+                             r.status)
     except ClientError:
         logger.exception("Couldn't get map thumbnail")
+    if thumbnail is not None:
+        _thumbnail_cache.put(name, thumbnail)
     return thumbnail
 
 async def refresh_db_maps() -> None:
     logger.info('Downloading map tiers')
     url = 'https://kztimerglobal.com/api/v2.0/maps?limit=9999'
     try:
-        async with ClientSession() as session:
-            async with session.get(url) as r:
-                if r.status != 200:
-                    logger.error("Couldn't get global API maps (HTTP %d)",
-                                 r.status)
-                    return
-                json = await r.json()
-    except ClientError:
+        session = await get_session()
+        async with session.get(url) as r:
+            if r.status != 200:
+                logger.error("Couldn't get global API maps (HTTP %d)",
+                             r.status)
+                return
+            json = orjson.loads(await r.read())
+    except (ClientError, orjson.JSONDecodeError):
         logger.exception("Couldn't get global API maps")
         return
 
@@ -241,15 +287,17 @@ async def refresh_db_maps() -> None:
     logger.info('Refreshed map database (%d new, %d updated, %d deleted)',
                 new, updated, deleted)
 
+@singleflight
 async def map_for_name(name: str, mode: Mode) -> APIMap:
-    if not re.fullmatch('[A-za-z0-9_]+', name):
+    if not _MAP_NAME_RE.fullmatch(name):
         raise APIMapError('Invalid map name')
 
     db_map = None
     try:
         db_map = await Map.get(name__iexact=name)
     except DoesNotExist:
-        db_maps = list(await Map.filter(name__icontains=name))
+        db_maps = list(await Map.filter(name__icontains=name)
+                       .limit(MAX_AMBIGUOUS_MAPS + 1))
         if len(db_maps) > 1:
             raise APIMapAmbiguousError(db_maps)
         elif db_maps:
@@ -265,13 +313,11 @@ async def map_for_name(name: str, mode: Mode) -> APIMap:
         json = {}
         url = f'https://kztimerglobal.com/api/v2.0/maps/name/{name}'
         try:
-            async with ClientSession() as session:
-                async with session.get(url) as r:
-                    if r.status != 200:
-                        raise APIError("Couldn't get global API map "
-                                       '(HTTP %d)' % r.status)
-                    json = await r.json()
-        except ClientError as e:
+            session = await get_session()
+            async with session.get(url) as r:
+                check_status(r, APIError, "Couldn't get global API map")
+                json = orjson.loads(await r.read())
+        except (ClientError, orjson.JSONDecodeError) as e:
             raise APIError("Couldn't get global API map") from e
 
         if json is None:
@@ -284,21 +330,26 @@ async def map_for_name(name: str, mode: Mode) -> APIMap:
         vnl_tier = vnl_pro_tier = thumbnail = None
 
     if mode == Mode.VNL and (vnl_tier is None or vnl_pro_tier is None):
-        try:
-            vnl_tier, vnl_pro_tier = await _vnl_tiers_for_map(name)
-        except APIError:
-            logger.exception("Couldn't get vnl.kz map tiers")
-            vnl_tier = vnl_pro_tier = None
-
+        tiers_coro = _vnl_tiers_or_none(name)
+    else:
+        tiers_coro = _value((vnl_tier, vnl_pro_tier))
     if thumbnail is None:
-        thumbnail = await _thumbnail_for_map(name)
+        thumbnail_coro = _thumbnail_for_map(name)
+    else:
+        thumbnail_coro = _value(thumbnail)
+    (vnl_tier, vnl_pro_tier), thumbnail = await asyncio.gather(tiers_coro,
+                                                               thumbnail_coro)
+
+    if (db_map is not None and db_map.thumbnail is None and
+        thumbnail is not None):
+        db_map.thumbnail = thumbnail
+        await db_map.save(update_fields=['thumbnail'])
 
     return APIMap(name=name, tier=tier, vnl_tier=vnl_tier,
                   vnl_pro_tier=vnl_pro_tier, thumbnail=thumbnail)
 
-def _mode_for_record(record: dict) -> Mode:
-    mode = {'kz_timer': Mode.KZT, 'kz_simple': Mode.SKZ,
-            'kz_vanilla': Mode.VNL}.get(record.get('mode', ''))
+def _mode_for_record(record: _Record) -> Mode:
+    mode = _MODES_BY_API_NAME.get(record.mode)
     if mode is None:
         raise APIError('Malformed global API PB (bad mode)')
     return mode
@@ -307,12 +358,11 @@ async def _records_for_steamid64(steamid64: int, mode: Mode,
                                  teleport_type: Type=Type.ANY,
                                  api_map: APIMap | None=None,
                                  stage: int | None=None,
-                                 limit: int | None=None) -> list[dict]:
-    api_mode = {Mode.KZT: 'kz_timer', Mode.SKZ: 'kz_simple',
-                Mode.VNL: 'kz_vanilla'}[mode]
+                                 limit: int | None=None
+                                 ) -> list[_Record]:
     url = ('https://kztimerglobal.com/api/v2.0/records/top?'
            f'steamid64={steamid64}&tickrate=128&'
-           f'modes_list_string={api_mode}')
+           f'modes_list_string={mode.api_name}')
     if stage is not None:
         url += f'&stage={stage}'
     if teleport_type == Type.TP:
@@ -326,72 +376,50 @@ async def _records_for_steamid64(steamid64: int, mode: Mode,
     else:
         url += '&limit=9999'
     try:
-        async with ClientSession() as session:
-            async with session.get(url) as r:
-                if r.status != 200:
-                    raise APIError("Couldn't get global API PBs (HTTP %d)" %
-                                   r.status)
-                records = await r.json()
+        session = await get_session()
+        async with session.get(url) as r:
+            check_status(r, APIError, "Couldn't get global API PBs")
+            data = await r.read()
     except ClientError as e:
         raise APIError("Couldn't get global API PBs") from e
-    if not isinstance(records, list):
-        raise APIError('Malformed global API PBs (not a list)')
-    if records and not isinstance(records[0], dict):
-        raise APIError('Malformed global API PBs (not a list of dicts)')
-    return records
-
-def _record_to_pb(record: dict, api_map: APIMap) -> PersonalBest:
-    steamid64_str = record.get('steamid64')
-    if steamid64_str is None:
-        raise APIError('Malformed global API PB (missing steamid64)')
     try:
-        steamid64 = int(steamid64_str)
+        return _records_decoder.decode(data)
+    except msgspec.DecodeError as e:
+        raise APIError('Malformed global API PBs') from e
+
+def _record_to_pb(record: _Record, api_map: APIMap) -> PersonalBest:
+    try:
+        steamid64 = int(record.steamid64)
     except ValueError as e:
         raise APIError('Malformed global API PB (bad steamid64)') from e
-    player_name = record.get('player_name')
-    if not isinstance(player_name, str) and player_name is not None:
-        raise APIError('Malformed global API PB (bad player_name)')
     mode = _mode_for_record(record)
-    stage = record.get('stage')
-    record_id = record.get('id')
-    time = record.get('time')
-    teleports = record.get('teleports')
-    points = record.get('points')
-    created_on = record.get('created_on')
-    if (not isinstance(stage, int) or
-        not isinstance(record_id, int) or
-        not isinstance(time, float) or
-        not isinstance(teleports, int) or
-        not isinstance(points, int) or
-        not isinstance(created_on, str)):
-        raise APIError('Malformed global API PB')
     try:
-        date = datetime.fromisoformat(created_on)
+        # Global API timestamps are naive UTC
+        date = datetime.fromisoformat(record.created_on + '+00:00')
     except ValueError as e:
         raise APIError('Malformed global API PB (bad date)') from e
-    date = date.replace(tzinfo=timezone.utc)
 
-    return PersonalBest(id=record_id, steamid64=steamid64,
-                        player_name=player_name, map=api_map, stage=stage,
-                        time=timedelta(seconds=time), mode=mode,
-                        teleports=teleports, points=points, place=None,
-                        date=date)
+    return PersonalBest(id=record.id, steamid64=steamid64,
+                        player_name=record.player_name, map=api_map,
+                        stage=record.stage,
+                        time=timedelta(seconds=record.time), mode=mode,
+                        teleports=record.teleports, points=record.points,
+                        place=None, date=date)
 
 async def _place_for_pb(pb: PersonalBest) -> int:
     url = f'https://kztimerglobal.com/api/v2.0/records/place/{pb.id}'
     try:
-        async with ClientSession() as session:
-            async with session.get(url) as r:
-                if r.status != 200:
-                    raise APIError("Couldn't get global API PB place "
-                                   '(HTTP %d)' % r.status)
-                place = await r.json()
-    except ClientError as e:
+        session = await get_session()
+        async with session.get(url) as r:
+            check_status(r, APIError, "Couldn't get global API PB place")
+            place = orjson.loads(await r.read())
+    except (ClientError, orjson.JSONDecodeError) as e:
         raise APIError("Couldn't get global API PB place") from e
     if not isinstance(place, int):
         raise APIError('Malformed global API PB place (not an int)')
     return place
 
+@singleflight
 async def pb_for_steamid64(steamid64: int, api_map: APIMap, mode: Mode,
                            teleport_type: Type=Type.ANY, stage: int=0
                            ) -> PersonalBest | None:
@@ -413,6 +441,7 @@ async def pb_for_steamid64(steamid64: int, api_map: APIMap, mode: Mode,
         logger.exception("Couldn't get global API PB place")
     return pbs[0]
 
+@singleflight
 async def latest_pb_for_steamid64(steamid64: int, mode: Mode,
                                   teleport_type: Type=Type.ANY
                                   ) -> PersonalBest | None:
@@ -430,13 +459,10 @@ async def latest_pb_for_steamid64(steamid64: int, mode: Mode,
     if not records:
         return None
 
-    def sort_key(i: dict[str, str]) -> str:
-        return i.get('created_on', '')
-    records.sort(key=sort_key, reverse=True)
-    record = records[0]
+    record = max(records, key=lambda i: i.created_on)
     mode = _mode_for_record(record)
     try:
-        api_map = await map_for_name(record.get('map_name', ''), mode)
+        api_map = await map_for_name(record.map_name, mode)
     except APIMapError as e:
         raise APIError('Invalid map name from API PB') from e
     pb = _record_to_pb(record, api_map)
@@ -447,50 +473,45 @@ async def latest_pb_for_steamid64(steamid64: int, mode: Mode,
     return pb
 
 async def _record_for_map(api_map: APIMap, mode: Mode, teleport_type: Type,
-                          stage: int) -> dict | None:
-    api_mode = {Mode.KZT: 'kz_timer', Mode.SKZ: 'kz_simple',
-                Mode.VNL: 'kz_vanilla'}[mode]
+                          stage: int) -> _Record | None:
     url = ('https://kztimerglobal.com/api/v2.0/records/top'
            f'?map_name={api_map.name}&stage={stage}&'
-           f'modes_list_string={api_mode}&limit=1')
+           f'modes_list_string={mode.api_name}&limit=1')
     if teleport_type == Type.TP:
         url += '&has_teleports=true'
     elif teleport_type == Type.PRO:
         url += '&has_teleports=false'
     try:
-        async with ClientSession() as session:
-            async with session.get(url) as r:
-                if r.status != 200:
-                    raise APIError("Couldn't get global API WR "
-                                   '(HTTP %d)' % r.status)
-                records = await r.json()
+        session = await get_session()
+        async with session.get(url) as r:
+            check_status(r, APIError, "Couldn't get global API WR")
+            data = await r.read()
     except ClientError as e:
         raise APIError("Couldn't get global API WR") from e
-    if not isinstance(records, list):
-        raise APIError('Malformed global API WR (not a list)')
-    if records and not isinstance(records[0], dict):
-        raise APIError('Malformed global API WR (not a list of dicts)')
+    try:
+        records = _records_decoder.decode(data)
+    except msgspec.DecodeError as e:
+        raise APIError('Malformed global API WR') from e
     return records[0] if records else None
 
+@singleflight
 async def wrs_for_map(api_map: APIMap, mode: Mode, stage: int
                       ) -> list[PersonalBest]:
     records = [await _record_for_map(api_map, mode, teleport_type, stage)
                for teleport_type in (Type.TP, Type.PRO)]
     return [_record_to_pb(record, api_map) for record in records if record]
 
+@singleflight
 async def profile_for_steamid64(steamid64, mode: Mode) -> Profile:
-    api_mode_id = {Mode.KZT: 200, Mode.SKZ: 201, Mode.VNL: 202}[mode]
     url = ('https://kztimerglobal.com/api/v2.0/player_ranks?'
-           f'steamid64s={steamid64}&stages=0&mode_ids={api_mode_id}&'
+           f'steamid64s={steamid64}&stages=0&mode_ids={mode.api_id}&'
            'tickrates=128')
     try:
-        async with ClientSession() as session:
-            async with session.get(url) as r:
-                if r.status != 200:
-                    raise APIError("Couldn't get global API PBs (HTTP %d)" %
-                                   r.status)
-                results = await r.json()
-    except ClientError as e:
+        session = await get_session()
+        async with session.get(url) as r:
+            check_status(r, APIError, "Couldn't get global API PBs")
+            results = orjson.loads(await r.read())
+    except (ClientError, orjson.JSONDecodeError) as e:
         raise APIError("Couldn't get global API PBs") from e
     if not isinstance(results, list):
         raise APIError('Malformed global API ranks (not a list)')
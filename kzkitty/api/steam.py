@@ -1,7 +1,16 @@
 from urllib.parse import urlparse
 from xml.etree import ElementTree
 
-from aiohttp import ClientError, ClientSession
+from aiohttp import ClientError
+
+from kzkitty.api import TTLCache, check_status, get_session, singleflight
+
+_XML_CONTENT_TYPE = 'text/xml'
+_MAX_AVATAR_SIZE = 1024 * 1024
+
+_profile_cache: TTLCache[str, ElementTree.Element] = TTLCache(ttl=3600,
+                                                              maxsize=1024)
+_avatar_cache: TTLCache[int, bytes] = TTLCache(ttl=86400, maxsize=256)
 
 class SteamError(Exception):
     pass
@@ -10,21 +19,30 @@ class SteamValueError(SteamError):
     pass
 
 async def _get_steam_profile(url: str) -> ElementTree.Element:
+    xml = _profile_cache.get(url)
+    if xml is not None:
+        return xml
+
     try:
-        async with ClientSession() as session:
-            async with session.get(url) as r:
-                if r.status != 200 or r.content_type != 'text/xml':
-                    raise SteamError("Couldn't get Steam profile (HTTP %d)"
-                                     % r.status)
-                text = await r.text()
+        session = await get_session()
+        async with session.get(url) as r:
+            check_status(r, SteamError, "Couldn't get Steam profile")
+            if r.content_type != _XML_CONTENT_TYPE:
+                raise SteamError("Couldn't get Steam profile (not XML)")
+            data = await r.read()
     except ClientError as e:
         raise SteamError("Couldn't get Steam profile") from e
 
     try:
-        return ElementTree.fromstring(text)
+        xml = ElementTree.fromstring(data)
     except ElementTree.ParseError as e:
         raise SteamError("Couldn't parse Steam profile XML") from e
+    if xml.tag != 'profile':
+        raise SteamError('Malformed Steam profile XML (no profile)')
+    _profile_cache.put(url, xml)
+    return xml
 
+@singleflight
 async def steamid64_for_profile(url: str) -> int:
     u = urlparse(url)
     if u.netloc != 'steamcommunity.com':
@@ -40,23 +58,34 @@ async def steamid64_for_profile(url: str) -> int:
     except ValueError as e:
         raise SteamError('Malformed Steam profile XML (bad steamid64)') from e
 
+@singleflight
 async def avatar_for_steamid64(steamid64: int) -> bytes:
+    avatar_data = _avatar_cache.get(steamid64)
+    if avatar_data is not None:
+        return avatar_data
+
     url = f'https://steamcommunity.com/profiles/{steamid64}?xml=1'
     xml = await _get_steam_profile(url)
     avatar = xml.find('avatarFull')
-    if avatar is None or avatar.text is None:
+    if avatar is None or not avatar.text:
         raise SteamError('Malformed Steam profile XML (no avatar)')
 
     try:
-        async with ClientSession() as session:
-            async with session.get(avatar.text) as r:
-                if r.status != 200:
-                    raise SteamError("Couldn't get Steam avatar (HTTP %d)"
-                                     % r.status)
-                return await r.content.read()
+        session = await get_session()
+        async with session.get(avatar.text) as r:
+            check_status(r, SteamError, "Couldn't get Steam avatar")
+            buf = bytearray()
+            async for chunk in r.content.iter_chunked(65536):
+                buf.extend(chunk)
+                if len(buf) > _MAX_AVATAR_SIZE:
+                    raise SteamError('Steam avatar too large')
     except ClientError as e:
         raise SteamError("Couldn't get Steam avatar") from e
+    avatar_data = bytes(buf)
+    _avatar_cache.put(steamid64, avatar_data)
+    return avatar_data
 
+@singleflight
 async def name_for_steamid64(steamid64: int) -> str:
     url = f'https://steamcommunity.com/profiles/{steamid64}?xml=1'
     xml = await _get_steam_profile(url)
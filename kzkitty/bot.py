@@ -7,7 +7,8 @@ from arc import (AutocompleteData, AutodeferMode, GatewayClient,
 from hikari import Intents, Member, MessageFlag
 from tortoise.exceptions import DoesNotExist
 
-from kzkitty.api.kz import (APIError, APIMapError, APIMapAmbiguousError,
+from kzkitty.api.kz import (MAX_AMBIGUOUS_MAPS, APIError, APIMapError,
+                            APIMapAmbiguousError,
                             latest_pb_for_steamid64,
                             map_for_name, pb_for_steamid64,
                             profile_for_steamid64, wrs_for_map)
@@ -56,8 +57,8 @@ async def error_handler(ctx: GatewayContext, exc: Exception) -> None:
         await ctx.respond('Not registered', flags=MessageFlag.EPHEMERAL)
         return
     elif isinstance(exc, APIMapAmbiguousError):
-        if len(exc.db_maps) > 10:
-            await ctx.respond('More than 10 maps found',
+        if len(exc.db_maps) > MAX_AMBIGUOUS_MAPS:
+            await ctx.respond(f'More than {MAX_AMBIGUOUS_MAPS} maps found',
                               flags=MessageFlag.EPHEMERAL)
         else:
             map_names = sorted(m.name for m in exc.db_maps)
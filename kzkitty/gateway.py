@@ -3,6 +3,7 @@ import asyncio
 import hikari
 from aiocron import crontab
 
+from kzkitty.api import close_session
 from kzkitty.api.kz import refresh_db_maps
 from kzkitty.models import close_db, import_default_players, init_db
 
@@ -15,5 +16,6 @@ class GatewayBot(hikari.GatewayBot):
         await super().start(*args, **kwargs)
 
     async def close(self) -> None:
+        await close_session()
         await close_db()
         await super().close()
@@ -2,8 +2,10 @@ import csv
 import logging
 import os
 from enum import StrEnum
+from itertools import islice
 
 from tortoise import Model, Tortoise, fields
+from tortoise.transactions import in_transaction
 
 logger = logging.getLogger('kzkitty.models')
 
@@ -13,9 +15,19 @@ class Type(StrEnum):
     ANY = 'any'
 
 class Mode(StrEnum):
-    KZT = 'KZT'
-    SKZ = 'SKZ'
-    VNL = 'VNL'
+    api_name: str
+    api_id: int
+
+    def __new__(cls, value: str, api_name: str, api_id: int) -> 'Mode':
+        mode = str.__new__(cls, value)
+        mode._value_ = value
+        mode.api_name = api_name
+        mode.api_id = api_id
+        return mode
+
+    KZT = 'KZT', 'kz_timer', 200
+    SKZ = 'SKZ', 'kz_simple', 201
+    VNL = 'VNL', 'kz_vanilla', 202
 
 class Map(Model):
     map_id = fields.IntField()
@@ -36,7 +48,8 @@ class Player(Model):
 
 async def init_db() -> None:
     await Tortoise.init(
-        db_url=f"sqlite://{os.environ['KZKITTY_DB']}",
+        db_url=(f"sqlite://{os.environ['KZKITTY_DB']}?synchronous=NORMAL&"
+                'temp_store=MEMORY&mmap_size=268435456&cache_size=-65536'),
         modules={'models': ['kzkitty.models']},
     )
     await Tortoise.generate_schemas()
@@ -48,18 +61,34 @@ async def import_default_players() -> None:
     if default_player_file is None:
         return
 
-    users = []
+    fields = ('user_id', 'server_id', 'steamid64', 'mode')
+    columns = ', '.join(Player._meta.fields_db_projection[field]
+                        for field in fields)
+    placeholders = ', '.join('?' for _ in fields)
+    query = (f'INSERT INTO {Player._meta.db_table} ({columns}) '
+             f'VALUES ({placeholders})')
+
+    imported = 0
     with open(default_player_file, newline='') as csvfile:
         reader = csv.DictReader(csvfile)
-        for row in reader:
-            user_id = int(row['user_id'])
-            server_id = int(row['server_id'])
-            if not await Player.exists(user_id=user_id, server_id=server_id):
-                users.append(Player(user_id=user_id,
-                                    server_id=server_id,
-                                    steamid64=int(row['steamid64']),
-                                    mode=Mode(row['mode'])))
-    await Player.bulk_create(users)
-    if users:
-        logger.info('Imported %d players from %s', len(users),
+        async with in_transaction() as conn:
+            while chunk := list(islice(reader, 1000)):
+                rows = [(int(row['user_id']), int(row['server_id']),
+                         int(row['steamid64']), Mode(row['mode']))
+                        for row in chunk]
+                user_ids = [user_id for user_id, _, _, _ in rows]
+                existing = set(await Player.filter(user_id__in=user_ids)
+                               .using_db(conn)
+                               .values_list('user_id', 'server_id'))
+                users = []
+                for user_id, server_id, steamid64, mode in rows:
+                    if (user_id, server_id) in existing:
+                        continue
+                    existing.add((user_id, server_id))
+                    users.append([user_id, server_id, steamid64, mode.value])
+                if users:
+                    await conn.execute_many(query, users)
+                imported += len(users)
+    if imported:
+        logger.info('Imported %d players from %s', imported,
                     default_player_file)